@@ -4,11 +4,16 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
+import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PatchCollection, PolyCollection
 from matplotlib.patches import Rectangle
-from rpack import pack, packing_density, PackingImpossibleError
-from itertools import product
+from rpack import pack, bbox_size, PackingImpossibleError
+from itertools import product, islice, chain
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 
 def unique_rotation_combinations(shape, N):
@@ -21,19 +26,18 @@ def unique_rotation_combinations(shape, N):
     revshape = (shape[1], shape[0])
     output = []
     for i in range(N):
-        output.append([shape] * i + [revshape] * max(0, (N - i)))
+        # i < N, so there is always at least one rotated shape
+        sz = [shape] * i
+        sz.extend([revshape] * (N - i))
+        output.append(sz)
     output.append([shape] * N)
     return output
 
 
-def unique_keep_combinations(shape, N):
-    # !!--Assumes that all sizes are the same--!!
-    # Given N shapes of the format (w, h)
-    # Find all unique combinations of keep/ignore
-    # N sizes -> N+1 combinations
-    # If represented in binary with 3 sizes:
-    # [1, 1, 1], [1, 1, 0], [1, 0, 0], [0, 0, 0]
-    return [[shape] * i for i in range(N + 1)]
+def _check_sizes(sizes):
+    for s in sizes:
+        if not isinstance(s, tuple) or len(s) != 2:
+            raise TypeError("All sizes must be 2-tuples")
 
 
 def find_rotations(sizes, verbose=False):
@@ -44,28 +48,16 @@ def find_rotations(sizes, verbose=False):
     #  [(h1, w1), (w2, h2), ...],
     #  [(h1, w1), (h2, w2), ...],
     #  ...]
-    # Output will be between 1 and 2^N lists of N sizes
+    # Output is a generator of between 1 and 2^N lists of N sizes
 
-    for s in sizes:
-        if not isinstance(s, tuple) or len(s) != 2:
-            raise TypeError("All sizes must be 2-tuples")
+    _check_sizes(sizes)
 
     # Find unique symmetric and non-symmetric shapes
-    rotatable = {}
-    symmetric = {}
+    rotatable = Counter()
+    symmetric = Counter()
     for s in sizes:
         tmp = s if s[0] < s[1] else (s[1], s[0])
-
-        if s[0] == s[1]:
-            try:
-                symmetric[tmp] += 1
-            except KeyError:
-                symmetric[tmp] = 1
-        else:
-            try:
-                rotatable[tmp] += 1
-            except KeyError:
-                rotatable[tmp] = 1
+        (symmetric if s[0] == s[1] else rotatable)[tmp] += 1
 
     # Get combinations of non-symmetric shape rotations
     tmp = []
@@ -77,93 +69,298 @@ def find_rotations(sizes, verbose=False):
     for s, c in symmetric.items():
         prepend.extend([s] * c)
 
+    if verbose:
+        n_sets = 1
+        for c in rotatable.values():
+            n_sets *= c + 1
+        print(f"Found {n_sets} unique rotation sets of {len(sizes)} items")
+
+    # Sets are generated lazily since there can be up to 2^N of them
+    return _iter_rotations(prepend, tmp)
+
+
+def _iter_rotations(prepend, combinations):
     # Get all combinations of combinations and flatten
-    output = []
-    for values in product(*tmp):
-        sz = [*prepend]
+    # Every combination is a list, so each one can be extended directly
+    prepend = tuple(prepend)
+    for values in product(*combinations):
+        sz = list(prepend)
         for v in values:
-            if isinstance(v, list):
-                sz.extend(v)
-            else:
-                sz.append(v)
-        output.append(sz)
+            sz.extend(v)
+        yield sz
+
+
+def _nfdh_pack(sizes, max_width, max_height, total_area):
+    # Next-Fit Decreasing-Height shelf packing
+    # Places shapes left to right on shelves, tallest first, starting
+    # a new shelf whenever the current one is full.
+    # Returns (positions, density) with positions in the same order as
+    # sizes, or None if the shapes don't fit. Cheap, but may fail where
+    # pack() succeeds.
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i][1], reverse=True)
+
+    positions = [None] * len(sizes)
+    used_w = 0
+    shelf_x = 0
+    shelf_y = 0
+    shelf_h = 0
+    for i in order:
+        w, h = sizes[i]
+        if w > max_width:
+            return None
+        if shelf_x + w > max_width:
+            shelf_y += shelf_h
+            shelf_x = 0
+            shelf_h = 0
+        positions[i] = (shelf_x, shelf_y)
+        shelf_x += w
+        shelf_h = max(shelf_h, h)
+        used_w = max(used_w, shelf_x)
+
+    used_h = shelf_y + shelf_h
+    if used_h > max_height or used_w * used_h == 0:
+        return None
+    return tuple(positions), total_area / (used_w * used_h)
+
+
+def _bbox_density(sizes, positions, total_area):
+    # The total area of the shapes is known, so only the bounding box
+    # of the packing is needed to get the density
+    width, height = bbox_size(sizes, positions)
+    if width * height == 0:
+        # Nothing was packed
+        return 0.0
+    return total_area / (width * height)
+
+
+def _try_pack(sizes, max_width, max_height, total_area):
+    # Wrapper around pack()
+    # Returns (positions, density), or None if the shapes can't fit
+    try:
+        positions = pack(list(sizes), max_width, max_height)
+    except PackingImpossibleError:
+        return None
+    return positions, _bbox_density(sizes, positions, total_area)
+
+
+# Shared by every packing call, so threads are only started once
+_executor = None
+_executor_lock = Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor()
+    return _executor
+
+
+def _pack_chunk(chunk, max_width, max_height, total_area, cache=None):
+    # Pack several sets in one task to amortize the per-task overhead,
+    # since a single pack() call is very quick
+    # If cache is a dict, then results are reused for sets seen before
+    if cache is None:
+        return [_try_pack(c, max_width, max_height, total_area) for c in chunk]
+
+    results = []
+    for c in chunk:
+        key = (c, max_width, max_height)
+        if key not in cache:
+            cache[key] = _try_pack(c, max_width, max_height, total_area)
+        results.append(cache[key])
+    return results
+
+
+def _pool_results(chunks, max_width, max_height, total_area, cache=None):
+    # Yield (chunk, results) in order, keeping only a few chunks in flight
+    # so the chunks are generated no faster than they're packed
+    ex = _get_executor()
+    max_pending = 2 * (os.cpu_count() or 1)
+    window = deque()
+    try:
+        for chunk in chunks:
+            window.append(
+                (
+                    chunk,
+                    ex.submit(
+                        _pack_chunk, chunk, max_width, max_height, total_area, cache
+                    ),
+                )
+            )
+            if len(window) >= max_pending:
+                chunk, f = window.popleft()
+                yield chunk, f.result()
+        while len(window) > 0:
+            chunk, f = window.popleft()
+            yield chunk, f.result()
+    finally:
+        # Don't pack anything else if the caller stopped early
+        for _, f in window:
+            f.cancel()
+
+
+def _best_packing(
+    rot_combs, max_width, max_height, total_area, chunksize=32, cache=None
+):
+    # Given an iterable of size sets with the same total area, pack each
+    # one and return (sizes, positions, density) for the densest packing,
+    # or None if none of them fit
+    # If cache is a dict, then the sets must be tuples
+    rot_combs = iter(rot_combs)
+    chunks = iter(lambda: tuple(islice(rot_combs, chunksize)), ())
+
+    first = next(chunks, ())
+    if len(first) < chunksize or (os.cpu_count() or 1) == 1:
+        # Not worth handing work to other threads
+        chunk_results = (
+            (chunk, _pack_chunk(chunk, max_width, max_height, total_area, cache))
+            for chunk in chain([first], chunks)
+        )
+    else:
+        # pack() releases the GIL, so the chunks can be packed in parallel
+        chunk_results = _pool_results(
+            chain([first], chunks), max_width, max_height, total_area, cache
+        )
 
-    if verbose:
-        print(f"Found {len(output)} unique rotation sets of {len(sizes)} items")
+    best = None
+    best_density = -1.0
+    for chunk, results in chunk_results:
+        # Assume the best solution has the highest density
+        # Sets that can't fit within the limits are marked with -1
+        densities = np.fromiter(
+            (-1.0 if r is None else r[1] for r in results),
+            dtype=np.float64,
+            count=len(results),
+        )
+        i = int(densities.argmax())
+        if densities[i] > best_density:
+            best_density = float(densities[i])
+            best = (list(chunk[i]), list(results[i][0]), best_density)
 
-    return output
+            # Density can't exceed 100%, so no better solution exists
+            if best_density >= 1.0 - 1e-12:
+                break
+    chunk_results.close()
+
+    return best
 
 
 def find_optimal_packing(sizes, max_width, max_height, verbose=False):
     # Given a list of rectangles represented by 2-tuples of
     # the format [(w, h), (w, h), ...] find the optimal
     # packing within the given max width and height
-    rot_combs = find_rotations(sizes)
-
-    best_density = None
-    best_sizes = None
-    best_positions = None
-    for c in rot_combs:
-        try:
-            positions = pack(c, max_width, max_height)
-        except PackingImpossibleError:
-            # Can't fit the desired shapes within the limits
-            continue
 
-        # Assume the best solution has the highest density
-        density = packing_density(c, positions)
-        if best_density is None or density > best_density:
-            best_density = density
-            best_sizes = c
-            best_positions = positions
+    # Also checks that all sizes are 2-tuples
+    rotations = find_rotations(sizes)
+
+    # Rotation doesn't change area, so if the shapes can't fit by area
+    # then no rotation set will fit either
+    total_area = sum(w * h for w, h in sizes)
+    if total_area > max_width * max_height:
+        if verbose:
+            print("No solution found within max width and height!")
+        return None, None
+
+    # A shape that is too large in both orientations can never fit
+    for w, h in sizes:
+        if (w > max_width or h > max_height) and (h > max_width or w > max_height):
+            if verbose:
+                print("No solution found within max width and height!")
+            return None, None
+
+    # find_rotations already yields distinct sets. They are streamed, so
+    # enumeration stops early with the packing.
+    best = _best_packing(rotations, max_width, max_height, total_area)
 
-    if best_density is None:
+    if best is None:
         if verbose:
             print("No solution found within max width and height!")
         return None, None
     else:
+        best_sizes, best_positions, best_density = best
         if verbose:
             print(f"Best Density: {best_density:.1%}")
         return best_sizes, best_positions
 
 
-def find_sorted_areas(sizes, area, threshold=0.9, verbose=False):
+def _iter_sorted_areas(grid, areas, shapes, top_k=128):
+    # Yield [sizes, area] for each row of the keep-count grid, in
+    # descending order of area (ties keep their original order).
+    # If top_k is not None, then only the top_k largest rows are sorted
+    # up front, since callers usually stop after the first few sets.
+    # The rest are sorted in one pass only if they are needed.
+    rows = np.arange(len(areas))
+    if top_k is not None and len(rows) > top_k:
+        # Take every row at least as large as the top_k-th largest
+        kth = np.partition(areas, -top_k)[-top_k]
+        sel = areas >= kth
+        blocks = (rows[sel], rows[~sel])
+    else:
+        blocks = (rows,)
+
+    for block in blocks:
+        for i in block[np.argsort(-areas[block], kind="stable")]:
+            sz = []
+            for shape, c in zip(shapes, grid[i]):
+                sz.extend([shape] * int(c))
+            yield [sz, int(areas[i])]
+
+
+def _sorted_area_sets(
+    sizes, area, threshold=0.9, canonical=False, top_k=128, block=65536
+):
+    # Lazy version of find_sorted_areas
+    # Returns the number of valid sets and a generator of [sizes, area]
+
+    if canonical:
+        uniques = Counter(sizes)
+    else:
+        uniques = Counter(s if s[0] < s[1] else (s[1], s[0]) for s in sizes)
+
+    if len(uniques) == 0:
+        return 0, iter([])
+
+    shapes = list(uniques.keys())
+    unit_areas = np.array([w * h for (w, h) in shapes], dtype=np.int64)
+
+    # Each row holds how many of each unique shape to keep
+    # Rows are built and filtered in blocks, so only the valid rows of the
+    # full product of keep counts are ever stored
+    dims = [c + 1 for c in uniques.values()]
+    n_rows = 1
+    for d in dims:
+        n_rows *= d
+
+    grids = []
+    areas = []
+    for start in range(0, n_rows, block):
+        flat = np.arange(start, min(start + block, n_rows))
+        counts = np.stack(np.unravel_index(flat, dims), axis=1)
+        a = counts @ unit_areas
+
+        mask = (a > 0) & (a <= area)
+        if threshold is not None:
+            mask &= a >= threshold * area
+        grids.append(counts[mask])
+        areas.append(a[mask])
+    grid = np.concatenate(grids)
+    areas = np.concatenate(areas)
+
+    return len(areas), _iter_sorted_areas(grid, areas, shapes, top_k)
+
+
+def find_sorted_areas(sizes, area, threshold=0.9, verbose=False, canonical=False):
     # Given a list of rectangles represented by 2-tuples of
     # the format [(w, h), (w, h), ...] find which combinations
     # fit within a given area, then sort by total area of shapes.
     # If threshold is not None, then it represents the minimum %
     # of the given area that the shapes must cover to be valid.
+    # If canonical is True, then all sizes are already (min, max).
 
-    uniques = {}
-    for s in sizes:
-        tmp = s if s[0] < s[1] else (s[1], s[0])
-        try:
-            uniques[tmp] += 1
-        except KeyError:
-            uniques[tmp] = 1
-
-    tmp = []
-    for k, c in uniques.items():
-        tmp.append(unique_keep_combinations(k, c))
-
-    combs = []
-    for values in list(product(*tmp)):
-        sz = []
-        for v in values:
-            if isinstance(v, list):
-                sz.extend(v)
-            else:
-                sz.append(v)
-        if len(sz) > 0:
-            combs.append(sz)
-
-    output = []
-    for c in combs:
-        a = sum([t[0] * t[1] for t in c])
-        if a > 0 and a <= area and (threshold is None or a >= threshold * area):
-            output.append([c, a])
-
-    output.sort(key=lambda x: x[1], reverse=True)
+    # Every set is needed, so sort them all at once
+    _, sets = _sorted_area_sets(sizes, area, threshold, canonical, top_k=None)
+    output = list(sets)
 
     if verbose:
         print(
@@ -174,21 +371,82 @@ def find_sorted_areas(sizes, area, threshold=0.9, verbose=False):
     return [v[0] for v in output], [v[1] for v in output]
 
 
-def find_max_usage(sizes, width, height, threshold=0.9, verbose=False):
+def _homogeneous_max_usage(
+    shape, N, width, height, threshold=0.9, verbose=False, cache=None
+):
+    # Equivalent to find_max_usage for N copies of the same (min, max) shape
+    # Tries k = N..1 copies, each with every number of rotated copies
+    # If cache is a dict, then packings are reused across calls
+    area = width * height
+    unit = shape[0] * shape[1]
+    revshape = (shape[1], shape[0])
+
+    if unit == 0:
+        # Shapes without area can't use any of the sheet
+        if verbose:
+            print("No solutions found!")
+        return None, None
+
+    for k in range(min(N, area // unit), 0, -1):
+        if threshold is not None and k * unit < threshold * area:
+            break
+        if verbose:
+            print(f"> Trying {k} of {N} items...")
+
+        # With no rotations, or all of them, every shape has the same height
+        # and may stack into perfectly filled shelves. Nothing can beat that.
+        for sset in ((shape,) * k, (revshape,) * k):
+            shelf = _nfdh_pack(sset, width, height, k * unit)
+            if shelf is not None and shelf[1] >= 1.0 - 1e-12:
+                if verbose:
+                    print(f"Best Area Usage: {k*unit} of {area} ({k*unit/area:.1%})")
+                return list(sset), list(shelf[0])
+
+        # Squares look the same when rotated
+        n_rot = 1 if shape[0] == shape[1] else k + 1
+        rot_combs = [tuple([shape] * (k - r) + [revshape] * r) for r in range(n_rot)]
+        best = _best_packing(rot_combs, width, height, k * unit, cache=cache)
+
+        # Since we're evaluating in descending order of area used, the first valid solution is the best
+        if best is not None:
+            if verbose:
+                print(f"Best Area Usage: {k*unit} of {area} ({k*unit/area:.1%})")
+            return best[0], best[1]
+
+    if verbose:
+        print("No solutions found!")
+    return None, None
+
+
+def find_max_usage(
+    sizes, width, height, threshold=0.9, verbose=False, canonical=False, cache=None
+):
     # Given a list of rectangles represented by 2-tuples of
     # the format [(w, h), (w, h), ...] find the optimal combination
     # and placements to use as much area within the width and height as possible.
     # Threshold specifies the minimum % of area that must be used
+    # If canonical is True, then all sizes are already (min, max).
+    # If cache is a dict, then packings of a single repeated shape are
+    # reused across calls, e.g. when packing several sheets.
 
-    size_sets, areas = find_sorted_areas(
-        sizes, width * height, threshold, verbose=False
-    )
+    _check_sizes(sizes)
+
+    # Many copies of a single shape need far less searching
+    if canonical:
+        shapes = set(sizes)
+    else:
+        shapes = set(s if s[0] < s[1] else (s[1], s[0]) for s in sizes)
+    if len(shapes) == 1:
+        return _homogeneous_max_usage(
+            shapes.pop(), len(sizes), width, height, threshold, verbose, cache
+        )
 
-    N = len(size_sets)
+    # Sets are built lazily, since usually only the first few are tried
+    N, size_sets = _sorted_area_sets(sizes, width * height, threshold, canonical)
     if verbose:
         print(f"Found {N} sets of shapes that fit within given area")
 
-    for i, sset in enumerate(size_sets):
+    for i, (sset, sarea) in enumerate(size_sets):
         if verbose:
             print(f"> Trying set {i+1} of {N}...")
         best_sizes, best_positions = find_optimal_packing(sset, width, height)
@@ -197,7 +455,7 @@ def find_max_usage(sizes, width, height, threshold=0.9, verbose=False):
         if best_sizes is not None:
             if verbose:
                 print(
-                    f"Best Area Usage: {areas[i]} of {width*height} ({areas[i]/(width*height):.1%})"
+                    f"Best Area Usage: {sarea} of {width*height} ({sarea/(width*height):.1%})"
                 )
             return best_sizes, best_positions
         # print("No solutions")
@@ -208,53 +466,73 @@ def find_max_usage(sizes, width, height, threshold=0.9, verbose=False):
 
 
 def multi_sheet_packing(sizes, width, height, max_sheets=10, verbose=True):
-    remaining_sizes = [*sizes]
+    # Track remaining items by (min, max) so rotated sizes map to the same key
+    remaining = Counter(tuple(sorted(s)) for s in sizes)
+
+    # Map both orientations of each shape to its key once, up front
+    canon = {}
+    for k in remaining:
+        canon[k] = k
+        canon[(k[1], k[0])] = k
+
+    # Sheets of the same shape retry the same sets, so share packings
+    cache = {}
+
     sheets = []
-    while len(remaining_sizes) > 0:
-        located_sizes, positions = find_max_usage(remaining_sizes, width, height, None)
+    while sum(remaining.values()) > 0:
+        located_sizes, positions = find_max_usage(
+            list(remaining.elements()), width, height, None, canonical=True, cache=cache
+        )
         if located_sizes is None:
             break
         sheets.append([located_sizes, positions])
         for s in located_sizes:
-            if s in remaining_sizes:
-                remaining_sizes.remove(s)
-            elif (s[1], s[0]) in remaining_sizes:
-                remaining_sizes.remove((s[1], s[0]))
+            remaining[canon[s]] -= 1
         if len(sheets) >= max_sheets:
             break
 
     if verbose:
-        items = sum([len(s[0]) for s in sheets])
+        items = sum(len(s[0]) for s in sheets)
         print(f"Fit {items} items on {len(sheets)} sheets")
 
     return sheets
 
 
+def _rect_vertices(sizes, positions):
+    # Given a list of rectangles represented by 2-tuples of
+    # the format [(w, h), (w, h), ...] and their positions
+    # represented by 2-tuples of [(x, y), (x, y), ...]
+    # return the corners of each rectangle as an (N, 4, 2) array
+    sz = np.asarray(sizes, dtype=float).reshape(-1, 2)
+    pos = np.asarray(positions, dtype=float).reshape(-1, 2)
+
+    verts = np.empty((len(pos), 4, 2))
+    verts[:, 0] = pos
+    verts[:, 1, 0] = pos[:, 0] + sz[:, 0]
+    verts[:, 1, 1] = pos[:, 1]
+    verts[:, 2] = pos + sz
+    verts[:, 3, 0] = pos[:, 0]
+    verts[:, 3, 1] = pos[:, 1] + sz[:, 1]
+    return verts
+
+
 def plot_text(axs, sizes, positions):
-    for i, p in enumerate(positions):
-        cx = p[0] + sizes[i][0] / 2
-        cy = p[1] + sizes[i][1] / 2
-        if sizes[i][0] < sizes[i][1]:
-            axs.text(
-                cx,
-                cy,
-                str(sizes[i]),
-                rotation="vertical",
-                rotation_mode="anchor",
-                ha="center",
-                va="center",
-                fontsize=10,
-            )
-        else:
-            axs.text(
-                cx,
-                cy,
-                str(sizes[i]),
-                rotation_mode="anchor",
-                ha="center",
-                va="center",
-                fontsize=10,
-            )
+    if len(positions) == 0:
+        return
+
+    sz = np.asarray(sizes)
+    centers = np.asarray(positions) + sz / 2
+    vertical = sz[:, 0] < sz[:, 1]
+
+    common_kw = dict(rotation_mode="anchor", ha="center", va="center", fontsize=10)
+    for i, (cx, cy) in enumerate(centers):
+        axs.text(
+            cx,
+            cy,
+            str(sizes[i]),
+            rotation="vertical" if vertical[i] else "horizontal",
+            **common_kw,
+        )
 
 
 def plot_positions(sizes, positions, max_width, max_height, show_sizes=True):
@@ -275,10 +553,9 @@ def plot_positions(sizes, positions, max_width, max_height, show_sizes=True):
     if show_sizes:
         plot_text(axs[0], sizes, positions)
 
-    rects = []
-    for i, p in enumerate(positions):
-        rects.append(Rectangle(p, *sizes[i]))
-    axs[0].add_collection(PatchCollection(rects, alpha=1, ec="k", fc="white"))
+    axs[0].add_collection(
+        PolyCollection(_rect_vertices(sizes, positions), alpha=1, ec="k", fc="white")
+    )
 
     axs[0].set_ylim(-1, max_height + 1)
     axs[0].set_xlim(-1, max_width + 1)
@@ -315,10 +592,11 @@ def multi_plot_positions(sheets, max_width, max_height, show_sizes=True):
     for j, (sizes, positions) in enumerate(sheets):
         if show_sizes:
             plot_text(axs[j], sizes, positions)
-        rects = []
-        for i, p in enumerate(positions):
-            rects.append(Rectangle(p, *sizes[i]))
-        axs[j].add_collection(PatchCollection(rects, alpha=1, ec="k", fc="white"))
+        axs[j].add_collection(
+            PolyCollection(
+                _rect_vertices(sizes, positions), alpha=1, ec="k", fc="white"
+            )
+        )
 
         axs[j].set_ylim(-1, max_height + 1)
         axs[j].set_xlim(-1, max_width + 1)